@@ -1,39 +1,322 @@
-import boto3
+import hashlib
+import os
+import pickle
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import click
-import botocore
 
-session = boto3.Session(profile_name='shotty')
-ec2 = session.resource('ec2')
+MAX_WORKERS = 32
+BATCH_SIZE = 1000
+FILTER_SIZE = 200
+CACHE_FILE = os.path.expanduser('~/.shotty-cache')
+CACHE_TTL = 60
+SNAPSHOT_POLL_DELAY = 15
+SNAPSHOT_POLL_MAX_ATTEMPTS = 240
+WAITER_DELAY = 5
+WAITER_MAX_ATTEMPTS = 120
+STOPPABLE_STATES = ('pending', 'running')
+INSTANCE_ERROR_CODES = ('IncorrectInstanceState', 'UnsupportedOperation')
+
+
+def get_ec2(ctx):
+    """Return the EC2 resource for the --profile given to cli.
+
+    boto3 is imported and the session built on first use, so commands
+    that never reach AWS (e.g. --help) skip loading botocore's service
+    models, config and credentials.
+    """
+    obj = ctx.obj
+    if 'ec2' not in obj:
+        import boto3
+        obj['ec2'] = boto3.Session(
+            profile_name=obj['profile']).resource('ec2')
+    return obj['ec2']
+
+
+def cache_scope(ctx):
+    """Identify the profile, region and account a cached lookup belongs to.
+
+    Built from the profile name and the environment variables that can
+    change region or account under it, without touching boto3, so a cache
+    hit never builds a session. AWS_ACCESS_KEY_ID is hashed to keep it out
+    of the cache file.
+    """
+    access_key = os.environ.get('AWS_ACCESS_KEY_ID', '')
+    return (ctx.obj['profile'],
+            os.environ.get('AWS_REGION', ''),
+            os.environ.get('AWS_DEFAULT_REGION', ''),
+            os.environ.get('AWS_PROFILE', ''),
+            hashlib.sha256(access_key.encode()).hexdigest()[:16])
+
+
+def run_parallel(worker, ids, *args):
+    """Run worker(id, *args) for every id on a thread pool.
+
+    Each worker returns a (result, messages) tuple; messages are printed
+    as workers complete so output from different workers does not
+    interleave. Returns the results in completion order.
+    """
+    results = []
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        futures = [ex.submit(worker, id_, *args) for id_ in ids]
+        for f in as_completed(futures):
+            result, messages = f.result()
+            for m in messages:
+                print(m)
+            results.append(result)
+
+    return results
+
+
+def chunks(ids, size=BATCH_SIZE):
+    for n in range(0, len(ids), size):
+        yield ids[n:n + size]
+
+
+def is_instance_error(e):
+    """True if a ClientError blames particular instances rather than the
+    request as a whole (throttling, permissions, credentials)"""
+    code = e.response.get('Error', {}).get('Code', '')
+    return (code.startswith('InvalidInstanceID.')
+            or code in INSTANCE_ERROR_CODES)
+
+
+def batch_call(ec2, action, verb, ids):
+    """Call the EC2 client's `action` for ids, BATCH_SIZE ids per request.
+
+    If a batch is rejected because of particular instances, its ids are
+    retried one at a time so a single bad instance does not block the
+    rest. Any other error is reported once for the batch. Returns the ids
+    that succeeded.
+    """
+    import botocore.exceptions
+
+    call = getattr(ec2.meta.client, action)
+    done = []
+    for batch in chunks(ids):
+        try:
+            call(InstanceIds=batch)
+            done.extend(batch)
+            continue
+        except botocore.exceptions.ClientError as e:
+            if len(batch) == 1 or not is_instance_error(e):
+                print("Could not {0} {1} ".format(verb, ', '.join(batch))
+                      + str(e))
+                continue
+
+        for instance_id in batch:
+            try:
+                call(InstanceIds=[instance_id])
+                done.append(instance_id)
+            except botocore.exceptions.ClientError as e:
+                print("Could not {0} {1} ".format(verb, instance_id) + str(e))
+
+    return done
+
+
+def wait_for(ec2, state, ids):
+    """Block until every instance in ids reaches state.
+
+    One waiter polls each batch of ids, so a round costs a single
+    DescribeInstances however many instances are waiting.
+    """
+    waiter = ec2.meta.client.get_waiter(state)
+    config = {'Delay': WAITER_DELAY, 'MaxAttempts': WAITER_MAX_ATTEMPTS}
+    for batch in chunks(ids):
+        waiter.wait(InstanceIds=batch, WaiterConfig=config)
+
+
+def write_rows(rows):
+    """Write rows as ', '-separated lines with a single stdout write"""
+    sys.stdout.write(''.join(', '.join(row) + '\n' for row in rows))
+
+
+def wait_for_snapshots(ec2, snapshot_ids):
+    """Poll until every snapshot in snapshot_ids is completed or in error,
+    for at most SNAPSHOT_POLL_MAX_ATTEMPTS rounds.
+
+    Each round costs one DescribeSnapshots per FILTER_SIZE snapshots still
+    pending, however many snapshots there are in total. Snapshots are
+    matched with a snapshot-id filter rather than SnapshotIds, so one
+    deleted snapshot is reported on its own instead of failing the batch.
+    """
+    client = ec2.meta.client
+    pending = list(snapshot_ids)
+    for _ in range(SNAPSHOT_POLL_MAX_ATTEMPTS):
+        if not pending:
+            return
+        time.sleep(SNAPSHOT_POLL_DELAY)
+        still_pending = []
+        for batch in chunks(pending, FILTER_SIZE):
+            filters = [{'Name': 'snapshot-id', 'Values': batch}]
+            response = client.describe_snapshots(OwnerIds=['self'],
+                                                 Filters=filters)
+            found = set()
+            for s in response['Snapshots']:
+                found.add(s['SnapshotId'])
+                if s['State'] in ('completed', 'error'):
+                    print("Snapshot {0} of {1} {2}".format(
+                        s['SnapshotId'], s['VolumeId'], s['State']))
+                else:
+                    still_pending.append(s['SnapshotId'])
+            for snapshot_id in batch:
+                if snapshot_id not in found:
+                    print("Snapshot {0} not found".format(snapshot_id))
+        pending = still_pending
+
+    for snapshot_id in pending:
+        print("Gave up waiting for snapshot {0}".format(snapshot_id))
+
+
+def load_cache():
+    try:
+        with open(CACHE_FILE, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return {}
+
+
+def save_cache(cache):
+    """Write the unexpired cache entries to CACHE_FILE.
+
+    The data goes to a private (0600) temporary file that is renamed into
+    place, so concurrent runs never write to the same file and other
+    local users cannot read the cached instance data.
+    """
+    now = time.time()
+    live = {key: entry for key, entry in cache.items()
+            if now - entry[0] < CACHE_TTL}
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(CACHE_FILE))
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(live, f)
+        os.replace(tmp, CACHE_FILE)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+def filter_instances(ctx, project, instanceId, cache=False, refresh=False):
+    """Return the matching instances as DescribeInstances response dicts.
+
+    With cache set, results younger than CACHE_TTL seconds are read from
+    CACHE_FILE instead of EC2; refresh forces a new query but still
+    updates the cache.
+    """
+    if cache:
+        key = cache_scope(ctx) + (project, instanceId)
+        entries = load_cache()
+        entry = entries.get(key)
+        if entry and not refresh and time.time() - entry[0] < CACHE_TTL:
+            return entry[1]
+
+    instances = describe_instances(get_ec2(ctx), project, instanceId)
+
+    if cache:
+        entries[key] = (time.time(), instances)
+        save_cache(entries)
+
+    return instances
 
 
-def filter_instances(project, instanceId):
-    instances = []
+def forget_instances(ctx):
+    """Drop every cached lookup for the current profile, region and account.
+
+    Called when a command changes instance state; any listing in the same
+    scope may include the affected instances, not just the one that
+    matches the command's own filters.
+    """
+    scope = cache_scope(ctx)
+    entries = load_cache()
+    stale = [key for key in entries if key[:len(scope)] == scope]
+    if stale:
+        for key in stale:
+            del entries[key]
+        save_cache(entries)
+
+
+def describe_instances(ec2, project, instanceId):
+    filters = []
 
     if project:
-        filters = [{'Name': 'tag:Project', 'Values': [project]}]
-        instances = ec2.instances.filter(Filters=filters)
-    else:
-        instances = ec2.instances.all()
+        filters.append({'Name': 'tag:Project', 'Values': [project]})
 
     if instanceId:
-        instances = [i for i in instances if i.id == instanceId]
+        filters.append({'Name': 'instance-id', 'Values': [instanceId]})
 
-    return instances
+    paginator = ec2.meta.client.get_paginator('describe_instances')
+    pages = paginator.paginate(Filters=filters,
+                               PaginationConfig={'PageSize': 1000})
+
+    return [i for page in pages
+            for r in page['Reservations']
+            for i in r['Instances']]
+
+
+def volumes_by_instance(ec2, instance_ids):
+    """Map each instance id to its attached volumes with one
+    DescribeVolumes query per FILTER_SIZE instances"""
+    volumes = defaultdict(list)
+    for batch in chunks(instance_ids, FILTER_SIZE):
+        filters = [{'Name': 'attachment.instance-id', 'Values': batch}]
+        for v in ec2.volumes.filter(Filters=filters):
+            for a in v.attachments:
+                volumes[a['InstanceId']].append(v)
+
+    return volumes
+
+
+def snapshots_by_volume(ec2, volume_ids, states=None):
+    """Map each volume id to its snapshots, newest first, with one
+    DescribeSnapshots query per FILTER_SIZE volumes.
+
+    states, if given, restricts the query to snapshots with those statuses.
+    """
+    snapshots = defaultdict(list)
+    for batch in chunks(volume_ids, FILTER_SIZE):
+        filters = [{'Name': 'volume-id', 'Values': batch}]
+        if states:
+            filters.append({'Name': 'status', 'Values': states})
+        for s in ec2.snapshots.filter(OwnerIds=['self'], Filters=filters):
+            snapshots[s.volume_id].append(s)
+
+    for snaps in snapshots.values():
+        snaps.sort(key=lambda s: s.start_time, reverse=True)
 
+    return snapshots
 
-def has_pending_snapshot(volume):
-    snapshots = list(volume.snapshots.all())
-    return snapshots and snapshots[0] == 'pending'
+
+def current_snapshots(snapshots):
+    """From a newest-first list, keep the pending and failed snapshots
+    plus the most recent completed one"""
+    current = []
+    seen_completed = False
+    for s in snapshots:
+        if s.state == 'completed':
+            if seen_completed:
+                continue
+            seen_completed = True
+        current.append(s)
+
+    return current
 
 
 @click.group()
 @click.option('--profile', default="shotty",
               help="specify an AWS cli profile")
-def cli(profile):
+@click.pass_context
+def cli(ctx, profile):
     """Shotty manages snapshots"""
-    print("cli(profile) = {0}".format(profile))
-    session = boto3.Session(profile_name=profile)
-    ec2 = session.resource('ec2')
+    ctx.obj = {'profile': profile}
     return
 
 
@@ -49,23 +332,39 @@ def snapshots():
               help="List all snapshots")
 @click.option('--instance', 'instanceId', default=None, type=str,
               help="Target a specific EC2 instance by Id")
-def list_snapshots(project, list_all, instanceId):
+@click.option('--no-cache', 'no_cache', default=False, is_flag=True,
+              help="Query EC2 instead of the local instance cache")
+@click.option('--refresh-cache', 'refresh_cache', default=False,
+              is_flag=True,
+              help="Query EC2 and update the local instance cache")
+@click.pass_context
+def list_snapshots(ctx, project, list_all, instanceId, no_cache,
+                   refresh_cache):
     "List EC2 snapshots"
-    instances = filter_instances(project, instanceId)
+    instances = filter_instances(ctx, project, instanceId,
+                                 cache=not no_cache, refresh=refresh_cache)
+    volumes = volumes_by_instance(
+        get_ec2(ctx), [i['InstanceId'] for i in instances])
+    snapshots = snapshots_by_volume(
+        get_ec2(ctx), [v.id for vols in volumes.values() for v in vols])
+
+    rows = []
     for i in instances:
-        for v in i.volumes.all():
-            for s in v.snapshots.all():
-                print(', '.join((
+        for v in volumes[i['InstanceId']]:
+            snaps = snapshots[v.id]
+            if not list_all:
+                snaps = current_snapshots(snaps)
+            for s in snaps:
+                rows.append((
                     s.id,
                     v.id,
-                    i.id,
+                    i['InstanceId'],
                     s.state,
                     s.progress,
                     s.start_time.strftime("%c")
-                )))
+                ))
 
-                if s.state == 'completed' and not list_all:
-                    break
+    write_rows(rows)
     return
 
 
@@ -77,23 +376,32 @@ def volumes():
 @volumes.command('list')
 @click.option('--project', default=None,
               help="Only volumes for project (tag Project:<name>)")
-@click.option('--instance', default=None, type=str,
-              help="Only volumes for project (tag Project:<name>)")
 @click.option('--instance', 'instanceId', default=None, type=str,
               help="Target a specific EC2 instance by Id")
-def list_volumes(project, instanceId):
+@click.option('--no-cache', 'no_cache', default=False, is_flag=True,
+              help="Query EC2 instead of the local instance cache")
+@click.option('--refresh-cache', 'refresh_cache', default=False,
+              is_flag=True,
+              help="Query EC2 and update the local instance cache")
+@click.pass_context
+def list_volumes(ctx, project, instanceId, no_cache, refresh_cache):
     "List EC2 volumes"
-    instances = filter_instances(project, instanceId)
+    instances = filter_instances(ctx, project, instanceId,
+                                 cache=not no_cache, refresh=refresh_cache)
+    volumes = volumes_by_instance(
+        get_ec2(ctx), [i['InstanceId'] for i in instances])
 
+    rows = []
     for i in instances:
-        for v in i.volumes.all():
-            print(", ".join((
+        for v in volumes[i['InstanceId']]:
+            rows.append((
                 v.id,
-                i.id,
+                i['InstanceId'],
                 v.state,
                 str(v.size) + "GiB",
-                v.encrypted and "Encrypted" or "Not Encrpted")))
+                "Encrypted" if v.encrypted else "Not Encrypted"))
 
+    write_rows(rows)
     return
 
 
@@ -107,20 +415,29 @@ def instances():
               help="Only instance for project (tag Project:<name>)")
 @click.option('--instance', 'instanceId', default=None, type=str,
               help="Target a specific EC2 instance by Id")
-def list_instances(project, instanceId):
+@click.option('--no-cache', 'no_cache', default=False, is_flag=True,
+              help="Query EC2 instead of the local instance cache")
+@click.option('--refresh-cache', 'refresh_cache', default=False,
+              is_flag=True,
+              help="Query EC2 and update the local instance cache")
+@click.pass_context
+def list_instances(ctx, project, instanceId, no_cache, refresh_cache):
     "List EC2 instances"
-    instances = filter_instances(project, instanceId)
+    instances = filter_instances(ctx, project, instanceId,
+                                 cache=not no_cache, refresh=refresh_cache)
 
+    rows = []
     for i in instances:
-        tags = {t['Key']: t['Value'] for t in i.tags or []}
-        print(', '.join((
-            i.id,
-            i.instance_type,
-            i.placement['AvailabilityZone'],
-            i.state['Name'],
+        tags = {t['Key']: t['Value'] for t in i.get('Tags', [])}
+        rows.append((
+            i['InstanceId'],
+            i['InstanceType'],
+            i['Placement']['AvailabilityZone'],
+            i['State']['Name'],
             tags.get('Project', '<no project>'),
-            i.public_dns_name)))
+            i.get('PublicDnsName', '')))
 
+    write_rows(rows)
     return
 
 
@@ -131,21 +448,20 @@ def list_instances(project, instanceId):
               help="If --project is not set, exit command immediately unless --force is set")
 @click.option('--instance', 'instanceId', default=None, type=str,
               help="Target a specific EC2 instance by Id")
-def stop_instances(project, force, instanceId):
+@click.pass_context
+def stop_instances(ctx, project, force, instanceId):
     "Stop EC2 instances"
     if not project and not force:
         print("-project must be set unless --force=True")
         return
 
-    instances = filter_instances(project, instanceId)
-
-    for i in instances:
-        print("Stopping {0}...".format(i.id))
-        try:
-            i.stop()
-        except botocore.exceptions.ClientError as e:
-            print("Could not stop {0} ".format(i.id) + str(e))
-            continue
+    ctx.call_on_close(lambda: forget_instances(ctx))
+    ec2 = get_ec2(ctx)
+    ids = [i['InstanceId']
+           for i in filter_instances(ctx, project, instanceId)]
+    for instance_id in ids:
+        print("Stopping {0}...".format(instance_id))
+    batch_call(ec2, 'stop_instances', 'stop', ids)
 
     return
 
@@ -157,21 +473,20 @@ def stop_instances(project, force, instanceId):
               help="If --project is not set, exit command immediately unless --force is set")
 @click.option('--instance', 'instanceId', default=None, type=str,
               help="Target a specific EC2 instance by Id")
-def start_instances(project, force, instanceId):
+@click.pass_context
+def start_instances(ctx, project, force, instanceId):
     "Start EC2 instances"
     if not project and not force:
         print("-project must be set unless --force=True")
         return
 
-    instances = filter_instances(project, instanceId)
-
-    for i in instances:
-        print("Starting {0}...".format(i.id))
-        try:
-            i.start()
-        except botocore.exceptions.ClientError as e:
-            print("Could not start {0} ".format(i.id) + str(e))
-            continue
+    ctx.call_on_close(lambda: forget_instances(ctx))
+    ec2 = get_ec2(ctx)
+    ids = [i['InstanceId']
+           for i in filter_instances(ctx, project, instanceId)]
+    for instance_id in ids:
+        print("Starting {0}...".format(instance_id))
+    batch_call(ec2, 'start_instances', 'start', ids)
 
     return
 
@@ -183,43 +498,84 @@ def start_instances(project, force, instanceId):
                help="If --project is not set, exit command immediately unless --force is set")
 @click.option('--instance', 'instanceId', default=None, type=str,
               help="Target a specific EC2 instance by Id")
-def create_snapshots(project, force, instanceId):
+@click.option('--wait', 'wait', default=False, is_flag=True,
+              help="Wait for the new snapshots to complete")
+@click.pass_context
+def create_snapshots(ctx, project, force, instanceId, wait):
     "Create snapshot of volumes attached to EC2 instances"
     if not project and not force:
         print("-project must be set unless --force=True")
         return
 
-    instances = filter_instances(project, instanceId)
-
-    for i in instances:
-        try:
-            restart = True
-            if i.state == 'stopped':
-                restart = False
-            print("Stopping {0}".format(i.id))
-            i.stop()
-            i.wait_until_stopped()
-            for v in i.volumes.all():
-                if has_pending_snapshot(v):
-                    print(
-                        " Skipping {0}, snapshot already in progress".format(v.id))
-                    continue
-                print("Creating snapshot of {0}".format(v.id))
-                v.create_snapshot(Description="Created by Shotty")
-
-            print("Starting {0}".format(i.id))
-            if restart:
-                i.start()
-                i.wait_until_running()
-        except botocore.exceptions.ClientError as e:
-            print("Error creating snapshot {0} ".format(i.id) + str(e))
-            continue
+    import botocore.exceptions
+
+    ctx.call_on_close(lambda: forget_instances(ctx))
+    ec2 = get_ec2(ctx)
+    instances = filter_instances(ctx, project, instanceId)
+    already_stopped = [i['InstanceId'] for i in instances
+                       if i['State']['Name'] == 'stopped']
+    restart = [i['InstanceId'] for i in instances
+               if i['State']['Name'] in STOPPABLE_STATES]
+
+    stopped = []
+    snapshot_ids = []
+    error = None
+    try:
+        for instance_id in restart:
+            print("Stopping {0}".format(instance_id))
+        stopped = batch_call(ec2, 'stop_instances', 'stop', restart)
+        wait_for(ec2, 'instance_stopped', stopped)
+
+        ready = already_stopped + stopped
+        volumes = volumes_by_instance(ec2, ready)
+        volume_ids = {v.id for vols in volumes.values() for v in vols}
+        busy = snapshots_by_volume(ec2, list(volume_ids), ['pending'])
+        for volume_id in sorted(busy):
+            print(" Skipping {0}, snapshot already in progress".format(
+                volume_id))
+        volume_ids -= set(busy)
+        snapshot_ids = run_parallel(
+            _snapshot_one, volume_ids, ec2.meta.client)
+    except (botocore.exceptions.ClientError,
+            botocore.exceptions.WaiterError) as e:
+        error = e
+    finally:
+        # Whatever failed above, never leave instances we stopped down
+        for instance_id in stopped:
+            print("Starting {0}".format(instance_id))
+        started = batch_call(ec2, 'start_instances', 'start', stopped)
+
+    try:
+        wait_for(ec2, 'instance_running', started)
+        if wait and not error:
+            wait_for_snapshots(ec2, [s for s in snapshot_ids if s])
+    except (botocore.exceptions.ClientError,
+            botocore.exceptions.WaiterError) as e:
+        error = error or e
+
+    if error:
+        print("Error creating snapshots " + str(error))
+        return
 
     print("Job Done")
 
     return
 
 
+def _snapshot_one(volume_id, client):
+    import botocore.exceptions
+
+    # Low-level clients are thread-safe, so every worker shares one
+    try:
+        s = client.create_snapshot(VolumeId=volume_id,
+                                   Description="Created by Shotty")
+    except botocore.exceptions.ClientError as e:
+        return None, ["Error creating snapshot {0} ".format(volume_id)
+                      + str(e)]
+
+    return s['SnapshotId'], ["Creating snapshot of {0}".format(volume_id)]
+
+
 @ instances.command('reboot')
 @ click.option('--project', default=None,
                help="Only instances for project (tag Project:<name>)")
@@ -227,23 +583,50 @@ def create_snapshots(project, force, instanceId):
                help="If --project is not set, exit command immediately unless --force is set")
 @click.option('--instance', 'instanceId', default=None, type=str,
               help="Target a specific EC2 instance by Id")
-def reboot_instances(project, force, instanceId):
+@click.pass_context
+def reboot_instances(ctx, project, force, instanceId):
     "Reboot EC2 instances"
     if not project and not force:
         print("-project must be set unless --force=True")
         return
 
-    instances = filter_instances(project, instanceId)
+    import botocore.exceptions
+
+    ctx.call_on_close(lambda: forget_instances(ctx))
+    ec2 = get_ec2(ctx)
+    ids = [i['InstanceId']
+           for i in filter_instances(ctx, project, instanceId)
+           if i['State']['Name'] in STOPPABLE_STATES]
+
+    stopped = []
+    error = None
+    try:
+        for instance_id in ids:
+            print("Rebooting {0}".format(instance_id))
+            print("Stopping {0}".format(instance_id))
+        stopped = batch_call(ec2, 'stop_instances', 'stop', ids)
+        wait_for(ec2, 'instance_stopped', stopped)
+    except (botocore.exceptions.ClientError,
+            botocore.exceptions.WaiterError) as e:
+        error = e
+    finally:
+        # Whatever failed above, never leave instances we stopped down
+        for instance_id in stopped:
+            print("Restarting {0}".format(instance_id))
+        started = batch_call(ec2, 'start_instances', 'start', stopped)
+
+    try:
+        wait_for(ec2, 'instance_running', started)
+    except (botocore.exceptions.ClientError,
+            botocore.exceptions.WaiterError) as e:
+        error = error or e
+
+    if error:
+        print("Could not reboot instances " + str(error))
+        return
 
-    for i in instances:
-        print("Rebooting {0}".format(i.id))
-        print("Stopping {0}".format(i.id))
-        i.stop()
-        i.wait_until_stopped()
-        print("Restarting {0}".format(i.id))
-        i.start()
-        i.wait_until_running()
-        print("Reboot for {0} complete".format(i.id))
+    for instance_id in started:
+        print("Reboot for {0} complete".format(instance_id))
 
     print("Rebooting complete")
 